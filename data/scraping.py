@@ -1,123 +1,200 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
+from selectolax.lexbor import LexborHTMLParser
 import time
+import asyncio
+import uvloop
+import aiofiles
 from typing import List, Dict
-import pandas as pd
+import csv
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os  # Add this import
 from datetime import datetime  # Add this import
 import math
-from concurrent.futures import ThreadPoolExecutor
-import threading  # Add this import
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import count
+import threading
 
 
-def get_listings_page(page_url: str) -> List[str]:
+# Common headers: ask for compressed HTML (~5x fewer bytes on the wire)
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': 'text/html',
+    'Accept-Encoding': 'gzip, deflate, br',
+}
+
+# CSS selectors shared by all listing detail pages
+LABEL_CONTAINER_SELECTOR = 'div.css-t7cajz.e15n0fyo1'  # Label-value pair containers
+SPAN_VALUE_SELECTOR = 'span.css-axw7ok'  # Multi-value spans inside a value paragraph
+
+
+class TokenBucket:
+    """Async token-bucket rate limiter shared by all in-flight fetches"""
+
+    def __init__(self, rate_per_sec: float, burst: int = 20):
+        self.rate = rate_per_sec
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ThreadTokenBucket:
+    """Thread-safe token-bucket rate limiter for the page-collection threads"""
+
+    def __init__(self, rate_per_sec: float, burst: int = 20):
+        self.rate = rate_per_sec
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_thread_local = threading.local()
+
+def _session() -> requests.Session:
+    """Per-thread Session with pooling and retries (Session is not thread-safe)"""
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(
+            pool_connections=2, pool_maxsize=4,
+            max_retries=Retry(total=3, backoff_factor=0.5)))
+        _thread_local.session = session
+    return session
+
+def get_listings_page(limiter: ThreadTokenBucket, page_url: str) -> List[str]:
     """Get all listing URLs from a page"""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-    }
-    
     try:
-        response = requests.get(page_url, headers=headers)
+        limiter.acquire()
+        response = _session().get(page_url, headers=REQUEST_HEADERS, timeout=(5, 30))
         response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
+        tree = LexborHTMLParser(response.content)
+
         # Find all listing links
-        listings = soup.find_all('a', {'data-cy': 'listing-item-link'})
-        return ['https://www.otodom.pl/' + link['href'] for link in listings]
+        listings = tree.css('a[data-cy="listing-item-link"]')
+        return ['https://www.otodom.pl/' + link.attributes['href'] for link in listings]
     
     except Exception as e:
         print(f"Error fetching listings page: {e}")
         return []
 
-def extract_spans_from_p(p_element) -> List[str]:
-    """Extract text from span elements within a paragraph"""
-    spans = p_element.find_all('span', class_='css-axw7ok')
-    return [span.text.strip() for span in spans]
-
-def extract_label_value_pairs(soup, labels_to_find: List[str], container_class: str) -> Dict[str, str]:
-    """Extract data from label-value pair divs"""
+def extract_label_value_pairs(tree, reverse_labels: Dict[str, str]) -> Dict[str, str]:
+    """Extract data from label-value pair divs, keyed by final field name"""
     results = {}
-    containers = soup.find_all('div', class_=container_class)
-    
+    containers = tree.css(LABEL_CONTAINER_SELECTOR)
+
     for container in containers:
-        paragraphs = container.find_all('p')
+        paragraphs = container.css('p')
         if len(paragraphs) == 2:
-            label = paragraphs[0].text.strip()
-            if label in labels_to_find:
+            label = paragraphs[0].text().strip()
+            if label in reverse_labels:
                 # Check if second paragraph contains spans
-                spans = paragraphs[1].find_all('span', class_='css-axw7ok')
+                spans = paragraphs[1].css(SPAN_VALUE_SELECTOR)
                 if spans:
                     # Join multiple span values with semicolon
-                    value = '; '.join([span.text.strip() for span in spans])
+                    value = '; '.join([span.text().strip() for span in spans])
                 else:
                     # Regular text value
-                    value = paragraphs[1].text.strip()
-                results[label] = value
-    
+                    value = paragraphs[1].text().strip()
+                results[reverse_labels[label]] = value
+                if len(results) == len(reverse_labels):
+                    break  # All requested labels found
+
     return results
 
-def get_listing_details(listing_url: str, div_class_mapping: Dict[str, str], label_mapping: Dict[str, str]) -> Dict:
+def compile_class_selectors(div_class_mapping: Dict[str, str]) -> Dict[str, str]:
+    """Turn space-separated class strings into dotted CSS selectors once"""
+    return {field: '.' + selector.replace(' ', '.') for field, selector in div_class_mapping.items()}
+
+def parse_listing(html: bytes, listing_url: str, div_selectors: Dict[str, str],
+                  reverse_labels: Dict[str, str]) -> Dict:
     """
-    Extract details from individual listing page using two methods:
+    Parse a fetched listing page into a row dict using two methods:
     1. Direct div content using class selectors
     2. Label-value pairs from container divs
-    
-    div_class_mapping: Dict with keys as field names and values as CSS selectors for direct content
-    label_mapping: Dict with keys as field names and values as labels to search for in p tags
+
+    Runs in a worker process so tree walks never block the event loop.
+
+    div_selectors: Dict with keys as field names and values as precompiled CSS selectors
+    reverse_labels: Dict mapping labels found in p tags to final field names
     """
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-    }
-    
+    tree = LexborHTMLParser(html)
+
+    details = {'url': listing_url}
+
+    # Removed description scraping code
+
+    # Extract data from direct div content
+    for field, selector in div_selectors.items():
+        element = tree.css_first(selector)
+        details[field] = element.text().strip() if element else None
+
+    # Extract data from label-value pairs, already keyed by field name
+    details.update(extract_label_value_pairs(tree, reverse_labels))
+
+    return details
+
+async def get_listing_details(client: httpx.AsyncClient, parse_pool: ProcessPoolExecutor, listing_url: str,
+                              div_selectors: Dict[str, str], reverse_labels: Dict[str, str]) -> Dict:
+    """Fetch an individual listing page and parse it in the process pool"""
     try:
-        response = requests.get(listing_url, headers=headers)
+        response = await client.get(listing_url, headers=REQUEST_HEADERS)
         response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        details = {'url': listing_url}
-        
-        # Removed description scraping code
-        
-        # Extract data from direct div content
-        for field, selector in div_class_mapping.items():
-            element = soup.find(class_=selector)
-            details[field] = element.text.strip() if element else None
-        
-        # Extract data from label-value pairs
-        label_values = extract_label_value_pairs(
-            soup, 
-            list(label_mapping.values()), 
-            'css-t7cajz e15n0fyo1'  # The container class for label-value pairs
-        )
-        
-        # Map the found labels to our desired field names
-        for field, label in label_mapping.items():
-            details[field] = label_values.get(label)
-            
-        return details
-    
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            parse_pool, parse_listing, response.content, listing_url, div_selectors, reverse_labels)
+
     except Exception as e:
         print(f"Error fetching listing details: {e}")
         return {}
 
 def scrape_apartments(base_url: str, div_class_mapping: Dict[str, str],
-                      label_mapping: Dict[str, str], num_pages: int = 1, num_workers: int = 5):
+                      label_mapping: Dict[str, str], num_pages: int = 1, num_workers: int = 5,
+                      rate_per_sec: float = 10, output_format: str = 'parquet'):
     """Main function to scrape apartment listings"""
 
-    all_urls = []
+    all_urls = set()  # Deduplicates as pages arrive
 
-    # Collect all listing URLs and save them to a file
+    # Collect all listing URLs concurrently, under the same global rate budget
+    # as the listing fetches
     print("Collecting all listing URLs...")
-    for page in range(1, num_pages + 1):
-        print(f"Getting URLs from page {page}/{num_pages}")
-        page_url = base_url + f"&page={page}" if page > 1 else base_url
-        listing_urls = get_listings_page(page_url)
-        all_urls.extend(listing_urls)
-        print(f"Found {len(listing_urls)} listings on page {page}")
-        time.sleep(2)
-
-    # Remove duplicate URLs
-    unique_urls = list(set(all_urls))
+    page_limiter = ThreadTokenBucket(rate_per_sec)
+    page_urls = [base_url + (f"&page={page}" if page > 1 else '') for page in range(1, num_pages + 1)]
+    with ThreadPoolExecutor(max_workers=min(num_pages, 10)) as executor:
+        for listing_urls in executor.map(partial(get_listings_page, page_limiter), page_urls):
+            all_urls.update(listing_urls)
+    print(f"Found {len(all_urls)} unique listings across {num_pages} pages")
+
+    # Sort for a deterministic URLs file and batch order
+    unique_urls = sorted(all_urls)
     total_urls = len(unique_urls)
     print(f"Total unique listings collected: {total_urls}")
 
@@ -127,65 +204,107 @@ def scrape_apartments(base_url: str, div_class_mapping: Dict[str, str],
     output_dir = os.path.join(script_dir, f'scrape_output_{timestamp}')
     os.makedirs(output_dir, exist_ok=True)
 
-    # Save all URLs to a file
     urls_file = os.path.join(output_dir, 'listing_urls.txt')
-    with open(urls_file, 'w', encoding='utf-8') as f:
-        for url in unique_urls:
-            f.write(url + '\n')
-    print(f"Saved all listing URLs to {urls_file}")
 
     batch_size = num_workers * 1000
     total_batches = math.ceil(total_urls / batch_size)
-    urls_processed = 0  # Counter for URLs read from file
-    listings_scraped = 0  # Counter for listings scraped
-    counter_lock = threading.Lock()  # Lock for thread-safe updates
-
-    for batch_num in range(total_batches):
-        # Read the next batch of URLs from the file
-        with open(urls_file, 'r', encoding='utf-8') as f:
-            # Skip URLs already processed
-            for _ in range(urls_processed):
-                next(f)
-            batch_urls = [next(f).strip() for _ in range(min(batch_size, total_urls - urls_processed))]
-        urls_processed += len(batch_urls)
-        print(f"Processing batch {batch_num + 1}/{total_batches} with {len(batch_urls)} URLs")
-
-        # Divide batch_urls among workers
-        urls_per_worker = math.ceil(len(batch_urls) / num_workers)
-        url_chunks = [batch_urls[i:i + urls_per_worker] for i in range(0, len(batch_urls), urls_per_worker)]
-
-        def process_urls(url_chunk):
-            nonlocal listings_scraped
-            scraped_listings = []
-            start_time = time.time()
-            last_report_time = start_time
-
-            for url in url_chunk:
-                details = get_listing_details(url, div_class_mapping, label_mapping)
-                if details:
-                    scraped_listings.append(details)
-                    with counter_lock:
-                        listings_scraped += 1
+    output_fields = ['url'] + list(div_class_mapping) + list(label_mapping)
+    flush_size = 1000  # Rows held in memory before a flush to disk
 
+    if output_format == 'parquet':
+        # String-only schema; each flush becomes one zstd-compressed row group
+        output_file = os.path.join(output_dir, 'apartments.parquet')
+        schema = pa.schema([(name, pa.string()) for name in output_fields])
+        parquet_writer = pq.ParquetWriter(output_file, schema, compression='zstd')
+    else:
+        output_file = os.path.join(output_dir, 'apartments.csv')
+    counter = count(1)  # Atomic counter for listings scraped (next() is GIL-safe)
+    last_report_time = time.time()
+
+    limiter = TokenBucket(rate_per_sec)
+    div_selectors = compile_class_selectors(div_class_mapping)
+    reverse_labels = {label: field for field, label in label_mapping.items()}
+
+    async def fetch(client, parse_pool, semaphore, url):
+        nonlocal last_report_time
+        async with semaphore:
+            # Global politeness budget: fast responses claim the next token
+            # immediately instead of each fetch sleeping a flat second
+            await limiter.acquire()
+            details = await get_listing_details(client, parse_pool, url, div_selectors, reverse_labels)
+            if details:
+                listings_scraped = next(counter)
                 current_time = time.time()
                 if current_time - last_report_time >= 10:
-                    with counter_lock:
-                        print(f"Number of listings scraped: {listings_scraped}/{total_urls}")
+                    print(f"Number of listings scraped: {listings_scraped}/{total_urls}")
                     last_report_time = current_time
-                time.sleep(1)
+            return details
+
+    def write_rows(rows):
+        """Append scraped rows to the output file (Parquet row group or CSV)"""
+        if output_format == 'parquet':
+            parquet_writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            return
+        write_header = not os.path.exists(output_file) or os.path.getsize(output_file) == 0
+        with open(output_file, 'a', newline='', encoding='utf-8') as fp:
+            writer = csv.DictWriter(fp, fieldnames=output_fields)
+            if write_header:
+                writer.writeheader()
+            writer.writerows(rows)
 
-            # Save the batch of listings to CSV after processing the chunk
-            if scraped_listings:
-                df = pd.DataFrame(scraped_listings)
-                worker_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                output_file = os.path.join(output_dir, f'apartments_batch_{batch_num + 1}_{worker_timestamp}.csv')
-                df.to_csv(output_file, index=False, encoding='utf-8')
+    async def main():
+        loop = asyncio.get_running_loop()
 
-        # Use ThreadPoolExecutor to process URLs with multiple workers
-        with ThreadPoolExecutor(max_workers=num_workers) as executor:
-            executor.map(process_urls, url_chunks)
+        # Save all URLs to a file without blocking the event loop
+        async with aiofiles.open(urls_file, 'w', encoding='utf-8') as f:
+            await f.write('\n'.join(unique_urls) + '\n')
+        print(f"Saved all listing URLs to {urls_file}")
+
+        semaphore = asyncio.Semaphore(num_workers * 10)
+        transport = httpx.AsyncHTTPTransport(
+            http2=True, limits=httpx.Limits(max_connections=100), retries=3)
+        parse_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+        try:
+            async with httpx.AsyncClient(transport=transport,
+                                         timeout=httpx.Timeout(30.0, connect=5.0)) as client:
+                # Resolve DNS and negotiate TLS/HTTP-2 once before the fetch storm;
+                # subsequent requests multiplex over the warmed connection
+                try:
+                    await client.head(base_url, headers=REQUEST_HEADERS)
+                except httpx.HTTPError as e:
+                    print(f"Warm-up request failed: {e}")
+
+                for batch_num in range(total_batches):
+                    # Slice the next batch of URLs straight from memory
+                    batch_urls = unique_urls[batch_num * batch_size:(batch_num + 1) * batch_size]
+                    print(f"Processing batch {batch_num + 1}/{total_batches} with {len(batch_urls)} URLs")
+
+                    # Flush completed rows every flush_size listings so memory
+                    # stays bounded regardless of batch size
+                    buf = []
+                    for coro in asyncio.as_completed([fetch(client, parse_pool, semaphore, url) for url in batch_urls]):
+                        details = await coro
+                        if details:
+                            buf.append(details)
+                        if len(buf) >= flush_size:
+                            rows, buf = buf, []
+                            # CSV serialization runs off the event loop
+                            await loop.run_in_executor(None, write_rows, rows)
+                    if buf:
+                        await loop.run_in_executor(None, write_rows, buf)
+        finally:
+            parse_pool.shutdown()
+
+    uvloop.install()
+    try:
+        asyncio.run(main())
+    finally:
+        # Without the footer written at close, already-flushed row groups
+        # are unreadable — close even when the scrape aborts mid-run
+        if output_format == 'parquet':
+            parquet_writer.close()
 
-    print(f"Scraping completed. Total listings scraped: {listings_scraped}/{total_urls}")
+    print(f"Scraping completed. Total listings scraped: {next(counter) - 1}/{total_urls}")
 
 
 if __name__ == "__main__":